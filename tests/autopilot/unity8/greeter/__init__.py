@@ -17,7 +17,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import threading
+
 import dbus
+from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
 
 import ubuntuuitoolkit
 from autopilot.matchers import Eventually
@@ -25,38 +29,118 @@ from testtools.matchers import Equals
 from autopilot.utilities import sleep
 
 
+# The session bus needs a main loop to deliver the greeter's
+# PropertiesChanged signals.
+DBusGMainLoop(set_as_default=True)
+
+_GREETER_SIGNAL_TIMEOUT = 5
+
+_greeter_proxy = None
+_greeter_proxy_lock = threading.Lock()
+
+
 def hide_greeter_with_dbus():
-    dbus_proxy = _get_greeter_dbus_proxy()
     if _is_greeter_active():
-        dbus_proxy.HideGreeter()
+        dbus_proxy = _get_greeter_dbus_proxy()
+        try:
+            dbus_proxy.HideGreeter()
+        except dbus.DBusException:
+            _reset_greeter_dbus_proxy()
+            raise
 
 
 def show_greeter_with_dbus():
-    dbus_proxy = _get_greeter_dbus_proxy()
     if not _is_greeter_active():
-        dbus_proxy.ShowGreeter()
+        dbus_proxy = _get_greeter_dbus_proxy()
+        try:
+            dbus_proxy.ShowGreeter()
+        except dbus.DBusException:
+            _reset_greeter_dbus_proxy()
+            raise
 
 
 def wait_for_greeter():
-    Eventually(Equals(True), timeout=300).match(_is_greeter_active)
+    if not _wait_for_greeter_active_signal(True):
+        Eventually(Equals(True), timeout=300).match(_is_greeter_active)
 
 
 def wait_for_greeter_gone():
-    Eventually(Equals(False), timeout=300).match(_is_greeter_active)
+    if not _wait_for_greeter_active_signal(False):
+        Eventually(Equals(False), timeout=300).match(_is_greeter_active)
 
 
-def _get_greeter_dbus_proxy():
-    bus = dbus.SessionBus()
-    return bus.get_object('com.canonical.UnityGreeter', '/')
+def _wait_for_greeter_active_signal(active):
+    """Wait for the greeter to announce that IsActive changed to active.
 
+    :return: True if the greeter is in the expected state, False if it
+      wasn't announced before the timeout or the signal couldn't be
+      watched.
+
+    """
+    loop = GLib.MainLoop()
+    reached = []
+
+    def on_properties_changed(interface, changed, invalidated):
+        if (interface == 'com.canonical.UnityGreeter' and
+                'IsActive' in changed and
+                bool(changed['IsActive']) == active):
+            reached.append(True)
+            loop.quit()
 
-def _is_greeter_active():
     try:
-        dbus_proxy = _get_greeter_dbus_proxy()
-        return dbus_proxy.Get('com.canonical.UnityGreeter', 'IsActive')
-    except:
+        match = dbus.SessionBus().add_signal_receiver(
+            on_properties_changed,
+            signal_name='PropertiesChanged',
+            dbus_interface=dbus.PROPERTIES_IFACE,
+            bus_name='com.canonical.UnityGreeter',
+            path='/')
+    except (dbus.DBusException, RuntimeError):
         return False
 
+    try:
+        # Check after subscribing, so a change can't be missed in between.
+        if _is_greeter_active() == active:
+            return True
+        timeout_id = GLib.timeout_add_seconds(
+            _GREETER_SIGNAL_TIMEOUT, loop.quit)
+        loop.run()
+        if not reached:
+            return False
+        GLib.source_remove(timeout_id)
+        return True
+    finally:
+        match.remove()
+
+
+def _get_greeter_dbus_proxy():
+    global _greeter_proxy
+    with _greeter_proxy_lock:
+        if _greeter_proxy is None:
+            bus = dbus.SessionBus(private=False)
+            # Follow the name to the new owner when unity8 is restarted,
+            # instead of talking to the process that owned it before.
+            _greeter_proxy = bus.get_object(
+                'com.canonical.UnityGreeter', '/',
+                follow_name_owner_changes=True)
+        return _greeter_proxy
+
+
+def _reset_greeter_dbus_proxy():
+    global _greeter_proxy
+    with _greeter_proxy_lock:
+        _greeter_proxy = None
+
+
+def _is_greeter_active():
+    # Retry once with a new proxy, in case the cached one is stale.
+    for _ in range(2):
+        try:
+            dbus_proxy = _get_greeter_dbus_proxy()
+            return dbus_proxy.Get('com.canonical.UnityGreeter', 'IsActive')
+        except:
+            _reset_greeter_dbus_proxy()
+    return False
+
 
 class Greeter(ubuntuuitoolkit.UbuntuUIToolkitCustomProxyObjectBase):
     """A helper that understands the greeter screen."""
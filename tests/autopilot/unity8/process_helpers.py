@@ -17,9 +17,14 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import functools
 import logging
+import re
 import subprocess
+import threading
+import time
 
+import dbus
 import ubuntuuitoolkit
 from autopilot.introspection import get_proxy_object_for_existing_process
 
@@ -28,6 +33,28 @@ from unity8 import greeter
 
 logger = logging.getLogger(__name__)
 
+_INITCTL = '/sbin/initctl'
+
+# initctl status output is cached for a short while, so that helpers called
+# back to back don't fork a new initctl process each time.
+_STATUS_CACHE_TTL = 0.25
+_status_cache = {}
+_status_cache_lock = threading.Lock()
+
+# _upstart is set to _UPSTART_UNAVAILABLE once upstart can't be reached over
+# D-Bus, so later status queries go straight to initctl.
+_UPSTART_UNAVAILABLE = object()
+_UPSTART_UNREACHABLE_ERRORS = (
+    'org.freedesktop.DBus.Error.Disconnected',
+    'org.freedesktop.DBus.Error.FileNotFound',
+    'org.freedesktop.DBus.Error.NoReply',
+    'org.freedesktop.DBus.Error.NoServer',
+    'org.freedesktop.DBus.Error.NotSupported',
+    'org.freedesktop.DBus.Error.ServiceUnknown',
+)
+_upstart = None
+_upstart_unknown_jobs = set()
+
 
 class JobError(Exception):
     pass
@@ -60,14 +87,14 @@ def restart_unity_with_testability(*args):
     Passes *args arguments to the launched process.
 
     """
-    args += ("QT_LOAD_TESTABILITY=1",)
-    return restart_unity(*args)
+    return restart_unity(*args, env_extra={'QT_LOAD_TESTABILITY': '1'})
 
 
-def restart_unity(*args):
+def restart_unity(*args, env_extra=None):
     """Restarts (or starts) unity8 using the provided arguments.
 
-    Passes *args arguments to the launched process.
+    Passes *args arguments to the launched process, and the env_extra
+    variables to its environment.
 
     :raises subprocess.CalledProcessError: if unable to stop or start the
       unity8 upstart job.
@@ -77,30 +104,42 @@ def restart_unity(*args):
     if "start/" in status:
         stop_job('unity8')
 
-    pid = start_job('unity8', *args)
+    pid = start_job('unity8', *args, env_extra=env_extra)
     return _get_unity_proxy_object(pid)
 
 
-def start_job(name, *args):
+def start_job(name, *args, env_extra=None):
     """Start a job.
 
     :param str name: The name of the job.
     :param args: The arguments to be used when starting the job.
+    :param dict env_extra: Variables to add to the environment of the job.
     :return: The process id of the started job.
     :raises CalledProcessError: if the job failed to start.
 
     """
-    logger.info('Starting job {} with arguments {}.'.format(name, args))
-    command = ['/sbin/initctl', 'start', name] + list(args)
+    logger.info('Starting job %s with arguments %s.', name, args)
+    command = (_INITCTL, 'start', name) + args
+    if env_extra:
+        # upstart doesn't use the environment of initctl for the job, the
+        # job environment is passed as KEY=VALUE arguments.
+        command += tuple(
+            '{}={}'.format(key, value) for key, value in env_extra.items())
     try:
         output = subprocess.check_output(
             command,
             stderr=subprocess.STDOUT,
             universal_newlines=True,
         )
-        logger.info(output)
-        pid = get_job_pid(name)
+        logger.info('%s', output)
+        _invalidate_job_status(name)
+        # initctl start prints the new status of the job, which includes
+        # the process id.
+        pid = _get_started_job_pid(name, output)
+        if pid is None:
+            pid = get_job_pid(name)
     except subprocess.CalledProcessError as e:
+        _invalidate_job_status(name)
         e.args += ('Failed to start {}: {}.'.format(name, e.output),)
         raise
     else:
@@ -114,10 +153,10 @@ def get_job_pid(name):
     :raises JobError: if the job is not running.
 
     """
-    status = get_job_status(name)
-    if "start/" not in status:
+    pid = _get_started_job_pid(name, get_job_status(name))
+    if pid is None:
         raise JobError('{} is not in the running state.'.format(name))
-    return int(status.split()[-1])
+    return pid
 
 
 def get_job_status(name):
@@ -127,16 +166,23 @@ def get_job_status(name):
     :raises JobError: if it's not possible to get the status of the job.
 
     """
-    try:
-        return subprocess.check_output([
-            '/sbin/initctl',
-            'status',
-            name
-        ], universal_newlines=True)
-    except subprocess.CalledProcessError as error:
-        raise JobError(
-            "Unable to get {}'s status: {}".format(name, error)
-        )
+    with _status_cache_lock:
+        cached = _status_cache.get(name)
+        if cached is not None:
+            timestamp, status = cached
+            if time.monotonic() - timestamp < _STATUS_CACHE_TTL:
+                return status
+        status = _get_job_status_from_upstart(name)
+        if status is None:
+            try:
+                status = subprocess.check_output(
+                    (_INITCTL, 'status', name), universal_newlines=True)
+            except subprocess.CalledProcessError as error:
+                raise JobError(
+                    "Unable to get {}'s status: {}".format(name, error)
+                )
+        _status_cache[name] = (time.monotonic(), status)
+        return status
 
 
 def stop_job(name):
@@ -146,18 +192,31 @@ def stop_job(name):
     :raises CalledProcessError: if the job failed to stop.
 
     """
-    logger.info('Stopping job {}.'.format(name))
-    command = ['/sbin/initctl', 'stop', name]
+    logger.info('Stopping job %s.', name)
+    command = (_INITCTL, 'stop', name)
     try:
-        output = subprocess.check_output(
-            command,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-        )
-        logger.info(output)
+        if logger.isEnabledFor(logging.INFO):
+            output = subprocess.check_output(
+                command,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True,
+            )
+            logger.info('%s', output)
+        else:
+            # The output would not be logged, so only keep the errors.
+            subprocess.run(
+                command,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+                check=True,
+            )
     except subprocess.CalledProcessError as e:
-        e.args += ('Failed to stop {}: {}.'.format(name, e.output),)
+        e.args += (
+            'Failed to stop {}: {}.'.format(name, e.output or e.stderr),)
         raise
+    finally:
+        _invalidate_job_status(name)
 
 
 def is_job_running(name):
@@ -167,7 +226,114 @@ def is_job_running(name):
     :raises JobError: if it's not possible to get the status of the job.
 
     """
-    return 'start/' in get_job_status(name)
+    match = _get_job_status_re(name).search(get_job_status(name))
+    return match is not None and match.group('goal') == 'start'
+
+
+def _get_upstart_interface(bus):
+    global _upstart
+    if _upstart is None:
+        _upstart = dbus.Interface(
+            bus.get_object(
+                'com.ubuntu.Upstart', '/com/ubuntu/Upstart',
+                introspect=False),
+            'com.ubuntu.Upstart0_6')
+    return _upstart
+
+
+def _get_job_status_from_upstart(name):
+    """Return the status of a job in the format used by initctl.
+
+    The status is queried from upstart over D-Bus, which is a lot cheaper
+    than running initctl.
+
+    :param str name: The name of the job.
+    :return: The job status, or None if upstart couldn't be queried over
+      D-Bus.
+
+    """
+    global _upstart
+    if _upstart is _UPSTART_UNAVAILABLE or name in _upstart_unknown_jobs:
+        return None
+    try:
+        bus = dbus.SessionBus()
+        upstart = _get_upstart_interface(bus)
+        try:
+            job_path = upstart.GetJobByName(name)
+        except dbus.DBusException as error:
+            if (error.get_dbus_name() ==
+                    'com.ubuntu.Upstart0_6.Error.UnknownJob'):
+                _upstart_unknown_jobs.add(name)
+                return None
+            raise
+        job = dbus.Interface(
+            bus.get_object(
+                'com.ubuntu.Upstart', job_path, introspect=False),
+            'com.ubuntu.Upstart0_6.Job')
+        try:
+            instance_path = job.GetInstanceByName('')
+        except dbus.DBusException as error:
+            if (error.get_dbus_name() ==
+                    'com.ubuntu.Upstart0_6.Error.UnknownInstance'):
+                return '{} stop/waiting\n'.format(name)
+            raise
+        instance = bus.get_object(
+            'com.ubuntu.Upstart', instance_path, introspect=False)
+        try:
+            properties = instance.GetAll(
+                'com.ubuntu.Upstart0_6.Instance',
+                dbus_interface=dbus.PROPERTIES_IFACE)
+        except dbus.DBusException as error:
+            # The instance goes away when the job stops.
+            if error.get_dbus_name() in (
+                    'org.freedesktop.DBus.Error.UnknownObject',
+                    'org.freedesktop.DBus.Error.UnknownMethod'):
+                return '{} stop/waiting\n'.format(name)
+            raise
+    except dbus.DBusException as error:
+        logger.debug('Unable to get %s status from upstart: %s', name, error)
+        if error.get_dbus_name() in _UPSTART_UNREACHABLE_ERRORS:
+            _upstart = _UPSTART_UNAVAILABLE
+        return None
+
+    status = '{} {}/{}'.format(
+        name, properties['goal'], properties['state'])
+    for process, pid in properties['processes']:
+        if process == 'main':
+            status += ', process {}'.format(pid)
+    return status + '\n'
+
+
+@functools.lru_cache()
+def _get_job_status_re(name):
+    """Return a regex matching the initctl status line of a job."""
+    return re.compile(
+        r'^{} (?P<goal>\w+)/(?P<state>[\w-]+)'
+        r'(?:, process (?P<pid>\d+))?'.format(re.escape(name)),
+        re.M)
+
+
+def _get_started_job_pid(name, status):
+    """Return the main process id of a job from its status.
+
+    The job may still be starting (e.g. in the spawned or post-start state),
+    as long as its main process exists.
+
+    :return: The process id, or None if the job has no start goal or main
+      process.
+
+    """
+    match = _get_job_status_re(name).search(status)
+    if (match is None or
+            match.group('goal') != 'start' or
+            match.group('pid') is None):
+        return None
+    return int(match.group('pid'))
+
+
+def _invalidate_job_status(name):
+    with _status_cache_lock:
+        _status_cache.pop(name, None)
 
 
 def _get_unity_status():